@@ -16,7 +16,7 @@ Two aproaches are implemented.
    with the maximum size and advance by the width of that char. 100% accuracy!
  - Sliding-window template matching: a sliding window of the maximum size of the 
    character images runs over the screenshot. In each window, all of the character
-   images are matched using the opencv template matching function. The one with 
+   images are matched by their sum of squared differences (TM_SQDIFF template matching). The one with 
    the best match (least deviation) is taken, and the sliding window as advanced
    by the width of the matching char. 99% accuracy.
 
@@ -24,11 +24,16 @@ Two aproaches are implemented.
 Example:
  python3 extract-text-with-image-pixel-matching.py -s img/opening_003.png --ystart 194 img/char_* >stats.txt
 
+For many screenshots, pass their file names on stdin instead of starting the script for each of them
+(this also uses numba, if installed):
+ ls img/opening_*.png | python3 extract-text-with-image-pixel-matching.py --batch --ystart 194 img/char_* >stats.txt
+
 For other games:
  - Take screenshots and extract all character images like the one provided here. Files should be named
    "char_[REPORTED CHAR].png", e.g. "char_8.png" will later be printed as "8"
  - adapt char_name_translations in this code to match your filenames
  - play around with ystart, yend coordinates 
+ - images are compared in grayscale, so chars must differ in brightness, not only in color
 
 Credits:
  - https://stackoverflow.com/questions/67826760/how-to-detect-if-an-image-is-in-another-image
@@ -36,6 +41,8 @@ Credits:
 Requirements:
   - python 3.6+
   - opencv
+  - numba (optional, speeds up large screenshots; importing it takes about half a second, so it is
+    only used from NUMBA_MIN_PIXELS pixels on, or when ExtractTextWithPixelMatching.use_numba is set)
 
 
 Author: Mario Fasold
@@ -43,11 +50,18 @@ License: MIT
 
 """
 import cv2
-import time
+import numpy as np
 import pathlib
-import math
 import argparse
+import functools
+import itertools
 import logging
+import sys
+
+# numba is optional and only imported by compile_with_numba: importing it and loading the compiled
+# code takes about half a second, which the faster matching only makes up for on large screenshots
+numba = None
+NUMBA_MIN_PIXELS = 500000
 
 char_name_translations = {
     "slash": "/",
@@ -57,66 +71,288 @@ char_name_translations = {
 }
 
 
-def sliding_window(image, window_size, step=1):
+@functools.lru_cache(maxsize=None)
+def compile_with_numba(function, parallel=False):
     """
-    Slide a window through the image
+    Import numba and return the function compiled with it, or None if numba is not installed
     """
-    for y in range(0, image.shape[0] - window_size[1], step):
-        for x in range(0, image.shape[1] - window_size[0], step):
-            yield (x, y, image[y : y + window_size[1], x : x + window_size[0]])
+    global numba
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba.njit(cache=True, parallel=parallel)(function)
 
 
-class ExtractTextWithPixelMatching:
-    def get_best_image_match_above_theshold(self, img, treshold=10e-8):
-        """
-        Detect if img contains one of the defined characters, and return the best match, i.e.
-        the one which a) maches the pixels above a given treshold and b) has the maximum size
-        among the considered chars
-        """
-        best_score = 0
-        best_char = None
+def get_background_color(img):
+    """
+    The most common color of a grayscale image is taken as its background
+    """
+    return np.bincount(img.ravel()).argmax()
 
-        for char_name, template_img in self.possible_chars:
-            # Template matching using TM_SQDIFF: Perfect match => minimum value around 0.0
-            result = cv2.matchTemplate(img, template_img, cv2.TM_SQDIFF)
 
-            # Get value of best match, i.e. the minimum value
-            min_val = cv2.minMaxLoc(result)[0]
-            score = img.size - min_val  # make sure that among same-sized image the best one is selected
+@functools.lru_cache(maxsize=None)
+def load_char_images(char_image_files):
+    """
+    Load the char images as (char name, image) sorted by descending size, along with their stack
+    (see stack_char_images) and the (width, height) of the largest one. Cached by the tuple of
+    files, so processing several screenshots with the same chars loads and stacks them only once.
+    """
+    char_images = []
+    max_char_size = (0, 0)
+    for f in char_image_files:
+        char_name = f.stem[5:]
+        for k in char_name_translations.keys():
+            char_name = char_name.replace(k, char_name_translations[k])
+        img = cv2.imread(str(f), cv2.IMREAD_GRAYSCALE)
+        char_images.append((char_name, img))
+        if img.size > max_char_size[0] * max_char_size[1]:
+            max_char_size = (img.shape[1], img.shape[0])
+    # largest chars first, so the first match found is the largest one
+    char_images.sort(key=lambda c: c[1].size, reverse=True)
+    return char_images, stack_char_images(char_images), max_char_size
+
+
+def stack_char_images(char_images):
+    """
+    Pack the char images into one contiguous array, padded to the size of the largest char,
+    along with the true height and width of each char
+    """
+    max_height = max(img.shape[0] for _, img in char_images)
+    max_width = max(img.shape[1] for _, img in char_images)
+    templates = np.zeros((len(char_images), max_height, max_width), dtype=np.uint8)
+    heights = np.zeros(len(char_images), dtype=np.int32)
+    widths = np.zeros(len(char_images), dtype=np.int32)
+    for i, (_, img) in enumerate(char_images):
+        heights[i], widths[i] = img.shape[:2]
+        templates[i, : heights[i], : widths[i]] = img
+    return templates, heights, widths
+
+
+def get_char_masks(heights, widths, window_size):
+    """
+    Boolean masks of shape (char, height, width) marking the pixels of each char in the char stack
+    """
+    return (np.arange(window_size[0])[:, None] < heights[:, None, None]) & (
+        np.arange(window_size[1]) < widths[:, None, None]
+    )
+
 
-            if min_val <= treshold and score > best_score:
-                best_score = score
-                best_char = char_name, template_img
+def scan_exact_matches(large_img, templates, heights, widths, y_end, x_end):
+    """
+    Loop over all coordinates up to (x_end, y_end) and return (char index, x, y) of each match.
+    At each coordinate, the first of the templates whose pixels ALL match is taken, so templates
+    must be sorted by descending size. Comparison stops at the first mismatching pixel.
+    """
+    matches = []
+    for y in range(y_end):
+        x = 0
+        while x < x_end:
+            match = -1
+            for i in range(templates.shape[0]):
+                is_match = True
+                for dy in range(heights[i]):
+                    for dx in range(widths[i]):
+                        if large_img[y + dy, x + dx] != templates[i, dy, dx]:
+                            is_match = False
+                            break
+                    if not is_match:
+                        break
+                if is_match:
+                    match = i
+                    break
+            if match >= 0:
+                matches.append((match, x, y))
+                x += widths[match]
+            else:
+                x += 1
+    return matches
+
+
+def pack_bits(bits):
+    """
+    Pack the last axis of a binary array into uint64 lanes, one bit per element
+    """
+    packed = np.packbits(bits, axis=-1)
+    lanes = -(-packed.shape[-1] // 8)
+    padding = [(0, 0)] * (packed.ndim - 1) + [(0, lanes * 8 - packed.shape[-1])]
+    return np.pad(packed, padding).view(np.uint64)
+
+
+def pick_best_template_matches(deviation_maps, treshold):
+    """
+    Return, for each coordinate of deviation maps of shape (char, y, x), the index of the char with
+    the least deviation, or -1 if no char matches within the treshold. Ties go to the first char.
+    Unlike scan_exact_matches, this cannot run as plain Python, as it uses numba.prange: it must be
+    compiled with compile_with_numba (see get_numba_kernel) first.
+    """
+    best_chars = np.full(deviation_maps.shape[1:], -1, dtype=np.int32)
+    for y in numba.prange(deviation_maps.shape[1]):
+        for x in range(deviation_maps.shape[2]):
+            least_deviation = treshold
+            for i in range(deviation_maps.shape[0]):
+                deviation = deviation_maps[i, y, x]
+                if deviation < least_deviation or (best_chars[y, x] < 0 and deviation <= treshold):
+                    least_deviation = deviation
+                    best_chars[y, x] = i
+    return best_chars
+
+
+def walk_row_matches(best_chars, widths, y, x_end):
+    """
+    Return (char index, x, y) of the matches in a row, given the index of the char to pick at
+    each x (-1 for none), advancing by the width of each match. Only coordinates with a match
+    are visited.
+    """
+    matches = []
+    x = 0
+    for hit in np.flatnonzero(best_chars[:x_end] >= 0):
+        # skip matches overlapping the previous char
+        if hit >= x:
+            i = best_chars[hit]
+            matches.append((i, hit, y))
+            x = hit + widths[i]
+    return matches
 
-        return best_char
 
-    def extract_text_with_template_matching(self, large_img, window_size):
+class ExtractTextWithPixelMatching:
+    # use numba for all screenshots, not only for large ones (see NUMBA_MIN_PIXELS)
+    use_numba = False
+
+    def get_numba_kernel(self, function, large_img, parallel=False):
+        """
+        Return the function compiled with numba if that pays off for the screenshot, else None
+        """
+        if self.use_numba or large_img.size >= NUMBA_MIN_PIXELS:
+            return compile_with_numba(function, parallel)
+        return None
+
+    def get_template_match_maps(self, large_img, window_size):
+        """
+        Compute, for each of the possible chars, the deviation of its best match inside the window
+        of the given size at each coordinate of the screenshot. Returns an array of shape (char, y, x).
+        Squared differences are computed once for the whole screenshot; the best match inside each
+        window is then the minimum over the window positions the char fits in.
+        """
+        # Matching is done on the grayscale images: on binarized ones, the cheaper Hamming distance
+        # cannot tell apart chars that only differ in brightness, e.g. the separators from the glyphs
+        deviations = self.get_squared_differences(large_img)
+        map_height = large_img.shape[0] - window_size[1] + 1
+        map_width = large_img.shape[1] - window_size[0] + 1
+        deviation_maps = []
+        for i, (_, template_img) in enumerate(self.possible_chars):
+            positions_in_window = (
+                window_size[1] - template_img.shape[0] + 1,
+                window_size[0] - template_img.shape[1] + 1,
+            )
+            windows = np.lib.stride_tricks.sliding_window_view(deviations[:, :, i], positions_in_window)
+            deviation_maps.append(windows.min(axis=(-2, -1))[:map_height, :map_width])
+        return np.stack(deviation_maps)
+
+    def get_squared_differences(self, large_img, block_height=64):
+        """
+        Compute the sum of squared differences between each of the possible chars and the screenshot,
+        with the char placed at each coordinate. Returns an array of shape (y, x, char), valid where
+        the char fits into the screenshot. With a window w and a char c, the sum of squared differences
+        is |w|^2 + |c|^2 - 2 w.c; computed for all windows and chars at once, these are matrix products.
+        They are computed for blocks of rows, to keep the window copies small.
+        Values are integral and, by Cauchy-Schwarz, all terms are at most |w|^2 + |c|^2 <= 2 * 255^2
+        per char pixel. Below 2^24, i.e. for chars of up to 129 pixels, single precision is exact;
+        larger chars are computed in double precision.
+        """
+        templates, heights, widths = self.char_stack
+        window_size = templates.shape[1:]
+        dtype = np.float32 if 2 * 255**2 * (heights * widths).max() < 2**24 else np.float64
+        masks = get_char_masks(heights, widths, window_size).reshape(len(templates), -1).astype(dtype)
+        chars = templates.reshape(len(templates), -1).astype(dtype)
+        char_norms = (chars**2).sum(axis=-1)
+
+        # pad, so that there is a window at every coordinate; padding is masked out for all chars
+        padded = np.pad(large_img, ((0, window_size[0] - 1), (0, window_size[1] - 1)))
+        deviations = np.empty(large_img.shape + (len(templates),), dtype=dtype)
+        for y in range(0, large_img.shape[0], block_height):
+            block = padded[y : y + block_height + window_size[0] - 1]
+            windows = np.lib.stride_tricks.sliding_window_view(block, window_size).reshape(-1, chars.shape[1])
+            windows = windows.astype(dtype)
+            block_deviations = ((windows**2) @ masks.T + char_norms) - 2 * (windows @ chars.T)
+            deviations[y : y + block_height] = block_deviations.reshape(-1, large_img.shape[1], len(templates))
+        return deviations
+
+    def extract_text_with_template_matching(self, large_img, window_size, treshold=10e-8):
         """
         Extracts text using sliding-window template matching: a sliding window of the maximum size of the
         character images runs over the screenshot. In each window, all of the character
-        images are matched using the opencv template matching function. The one with
+        images are matched by their sum of squared differences (TM_SQDIFF template matching). The one with
         the best match (least deviation) is taken, and the sliding window as advanced
         by the width of the matching char. 99% accuracy.
         """
-        final_text = ""
-        window_iter = sliding_window(large_img, window_size, 1)
-        while True:
-            try:
-                x, y, window = next(window_iter)
-            except StopIteration:
-                break
-
-            best_image = self.get_best_image_match_above_theshold(window)
-            if best_image:
-                char_name, template_img = best_image
-                logging.info(f"Template {char_name} found at {x},{y}")
-                final_text += char_name
-
-                # advance by size of char
-                # @todo: this would not work if step !=1
-                for _ in range(template_img.shape[1] - 1):
-                    next(window_iter)
-        return final_text
+        if large_img.shape[0] - window_size[1] <= 0 or large_img.shape[1] - window_size[0] <= 0:
+            return ""
+        deviation_maps = self.get_template_match_maps(large_img, window_size)
+        pick_kernel = self.get_numba_kernel(pick_best_template_matches, large_img, parallel=True)
+        if pick_kernel:
+            best_chars = pick_kernel(deviation_maps, treshold)
+        else:
+            best_chars = np.where(deviation_maps.min(axis=0) <= treshold, deviation_maps.argmin(axis=0), -1)
+
+        _, _, widths = self.char_stack
+        matches = []
+        for y in range(large_img.shape[0] - window_size[1]):
+            matches += walk_row_matches(best_chars[y], widths, y, large_img.shape[1] - window_size[0])
+
+        chars = []
+        for i, x, y in matches:
+            char_name = self.possible_chars[i][0]
+            logging.info(f"Template {char_name} found at {x},{y}")
+            chars.append(char_name)
+        return "".join(chars)
+
+    def get_ink_map(self, large_img, window_size, background):
+        """
+        Compute a boolean map of shape (y, x) telling whether the window of the given (height, width)
+        at each coordinate contains anything but background. Where it does not, none of the possible
+        chars can match, unless one of them is made of background only: then the map is all True.
+        """
+        map_shape = (large_img.shape[0] - window_size[0] + 1, large_img.shape[1] - window_size[1] + 1)
+        if any((img == background).all() for _, img in self.possible_chars):
+            return np.ones(map_shape, dtype=bool)
+        # a dilation anchored at the top left corner is the maximum over the window at each coordinate
+        ink = (large_img != background).astype(np.uint8)
+        ink = cv2.dilate(ink, np.ones(window_size, dtype=np.uint8), anchor=(0, 0))
+        return ink[: map_shape[0], : map_shape[1]].astype(bool)
+
+    def get_exact_match_maps(self, large_img, templates, heights, widths, y_end):
+        """
+        Yield (y, match map) for each row up to y_end that is not only background, the map being a
+        boolean array of shape (x, char) holding True where ALL pixels of the char image match the
+        screenshot at that coordinate, using one sliding window of the maximum char size. Working
+        row by row keeps memory bounded for large screenshots.
+        Screenshot and chars are first reduced to one bit per pixel and packed into uint64 lanes, so
+        finding candidates for all chars is a single masked XOR per lane. Binarizing can merge
+        distinct colors, hence the candidates are then verified pixel-by-pixel.
+        """
+        window_size = templates.shape[1:3]
+        masks = get_char_masks(heights, widths, window_size)
+        # binarize to background / non-background
+        background = get_background_color(large_img)
+        ink_map = self.get_ink_map(large_img, window_size, background)
+        bin_img = (large_img != background).astype(np.uint8)
+        char_bits = pack_bits((templates != background).reshape(len(templates), -1))
+        mask_bits = pack_bits(masks.reshape(len(templates), -1))
+
+        for y in range(y_end):
+            if not ink_map[y].any():
+                continue
+            strip, bin_strip = large_img[y : y + window_size[0]], bin_img[y : y + window_size[0]]
+            bin_windows = np.lib.stride_tricks.sliding_window_view(bin_strip, window_size)[0]
+            packed_windows = pack_bits(bin_windows.reshape(bin_windows.shape[0], -1))
+            row_match_map = (((packed_windows[:, None] ^ char_bits) & mask_bits) == 0).all(axis=-1)
+
+            # only candidates with the same binary pattern need a full comparison
+            xs, cs = np.nonzero(row_match_map)
+            windows = np.lib.stride_tricks.sliding_window_view(strip, window_size)[0, xs]
+            row_match_map[xs, cs] = ((windows == templates[cs]) | ~masks[cs]).all(axis=(1, 2))
+            yield y, row_match_map
 
     def extract_text_with_exact_matching(self, large_img, max_char_size):
         """
@@ -124,47 +360,45 @@ class ExtractTextWithPixelMatching:
         matching all of the character images pixel-by-pixel. If multiple character images
         match, use the one with the maximum size and advance by the width of that char.
         """
-        final_text = ""
-        x, y = (0, 0)
-        while y < large_img.shape[0] - max_char_size[1]:
-            while x < large_img.shape[1] - max_char_size[0]:
-                # check which of the chars match at the current position
-                logging.debug(f"Checking coordinate {x},{y}")
-                matching_chars = []
-                for char_name, img in self.possible_chars:
-                    # check if ALL pixels match
-                    if (large_img[y : y + img.shape[0], x : x + img.shape[1]] == img).all():
-                        logging.info(f"Template {char_name} found at {x},{y}")
-                        matching_chars.append((char_name, img, img.size))
-
-                # pick the largest one
-                if matching_chars:
-                    largest_char = max(matching_chars, key=lambda l: l[2])  # some lambda funcion in shape[]
-                    final_text += largest_char[0]
-                    x += largest_char[1].shape[1]
-                else:
-                    x += 1
-            y += 1
-        return final_text
+        # possible chars are sorted by descending size, so the first match is the one to pick
+        templates, heights, widths = self.char_stack
+        # never read beyond the screenshot, even if max_char_size is smaller than the largest char
+        y_end = min(large_img.shape[0] - max_char_size[1], large_img.shape[0] - templates.shape[1] + 1)
+        x_end = min(large_img.shape[1] - max_char_size[0], large_img.shape[1] - templates.shape[2] + 1)
+        if y_end <= 0 or x_end <= 0:
+            return ""
+
+        scan_kernel = self.get_numba_kernel(scan_exact_matches, large_img)
+        if scan_kernel:
+            # a contiguous array lets numba index it as such (no copy if it already is)
+            large_img = np.ascontiguousarray(large_img)
+            matches = scan_kernel(large_img, templates, heights, widths, y_end, x_end)
+        else:
+            matches = []
+            row_match_maps = self.get_exact_match_maps(large_img, templates, heights, widths, y_end)
+            for y, row_match_map in row_match_maps:
+                best_chars = np.where(row_match_map.any(axis=-1), row_match_map.argmax(axis=-1), -1)
+                matches += walk_row_matches(best_chars, widths, y, x_end)
+
+        chars = []
+        for i, x, y in matches:
+            char_name = self.possible_chars[i][0]
+            logging.info(f"Template {char_name} found at {x},{y}")
+            chars.append(char_name)
+        return "".join(chars)
 
     def remove_consecutive_duplicate_seperators(self, text, sep=","):
         """
         Some chars (e.g. spaces) might be detected many times, but should be reported only once
         """
-        deduplicated = text[0] if text else ""
-        for c in text[1:]:
-            if c in sep and c == deduplicated[-1]:
-                continue
-            else:
-                deduplicated += c
-        return deduplicated
+        return "".join(c if c in sep else "".join(run) for c, run in itertools.groupby(text))
 
     def extract_text(self, screenshot_file, char_image_files, method, y_start=0, y_end=None):
         """
         Main method that loads screenshot, character images, and runs the selected method 
         """
-        # Import large image
-        large_img = cv2.imread(str(screenshot_file))
+        # Import large image, as grayscale to compare a third of the bytes
+        large_img = cv2.imread(str(screenshot_file), cv2.IMREAD_GRAYSCALE)
         large_img = large_img[
             y_start:y_end,
         ] 
@@ -173,19 +407,9 @@ class ExtractTextWithPixelMatching:
             cv2.waitKey(0)
 
         # Import chars
-        char_images = []
-        max_char_size = (0, 0)
-        for f in char_image_files:
-            char_name = f.stem[5:]
-            for k in char_name_translations.keys():
-                char_name = char_name.replace(k, char_name_translations[k])
-            img = cv2.imread(str(f))
-            char_images.append((char_name, img))
-            if img.size > max_char_size[0] * max_char_size[1]:
-                max_char_size = (img.shape[1], img.shape[0])
-        self.possible_chars = char_images
-
-        logging.info(f"Importet {len(char_images)} character images")
+        self.possible_chars, self.char_stack, max_char_size = load_char_images(tuple(char_image_files))
+
+        logging.info(f"Importet {len(self.possible_chars)} character images")
         logging.info(f"Maximum char size is {max_char_size}")
 
         # Extract text with sliding window & pixel-by-pixel matching
@@ -210,14 +434,20 @@ class ExtractTextWithPixelMatching:
         parser.add_argument(
             "char_images", nargs="+", type=pathlib.Path, help="List of images containing the chars to be extracted"
         )
-        parser.add_argument(
+        screenshots = parser.add_mutually_exclusive_group(required=True)
+        screenshots.add_argument(
             "-s",
             "--screenshot",
             dest="screenshot_file",
             type=pathlib.Path,
-            required=True,
             help="The image file containing the screenshot (png, tif)",
         )
+        screenshots.add_argument(
+            "--batch",
+            action="store_true",
+            help="Read the screenshot files from stdin, one per line, and extract the text of each of them "
+            "(uses numba if installed, whose import cost is shared by all screenshots)",
+        )
         parser.add_argument(
             "--matching-method", choices=["exact", "template"], default="exact", help="Extraction method"
         )
@@ -231,7 +461,14 @@ class ExtractTextWithPixelMatching:
         args.verbose = 70 - (10 * args.verbose) if args.verbose > 0 else 0
         logging.basicConfig(level=args.verbose)
 
-        self.extract_text(args.screenshot_file, args.char_images, args.matching_method, args.ystart, args.yend)
+        if args.batch:
+            # char images and numba kernels are loaded once and reused for all screenshots
+            self.use_numba = True
+            screenshot_files = (pathlib.Path(line.strip()) for line in sys.stdin if line.strip())
+        else:
+            screenshot_files = [args.screenshot_file]
+        for screenshot_file in screenshot_files:
+            self.extract_text(screenshot_file, args.char_images, args.matching_method, args.ystart, args.yend)
 
 
 et = ExtractTextWithPixelMatching()